@@ -1,16 +1,595 @@
 # Import the required libraries
 import azure.functions as func
 import logging
+import textblob
 from textblob import TextBlob
-from azure.storage.blob import BlobServiceClient
-import json,os, matplotlib.pyplot as plt
-from datetime import datetime
-import pandas as pd
-import io, base64
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobClient, BlobServiceClient, ContainerClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+import os,re, matplotlib
+import xml.etree.ElementTree as ET
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from datetime import datetime, timedelta, timezone
+import asyncio
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.json as pj
+import io, base64, hashlib
+from urllib.parse import quote
 
 # Define the azure function application
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+# The blob service clients, their container clients and the clients of the blobs read
+# on every invocation are created once per worker and reused. The small JSON records in
+# text-analyzed are read through a client with small get sizes, everything else uses
+# the SDK defaults
+_BSC = {}
+_CONTAINERS = {}
+_BLOBS = {}
+_SMALL_BLOB_GET_SIZE = 64 * 1024
+
+# The dashboard links to the visualization through a read-only SAS URL that is valid
+# for at least this long, so the browser fetches the image from blob storage directly
+_SAS_VALIDITY = timedelta(hours=1)
+
+# The dashboard page is static and read once, its script polls the stats function for
+# the statistics and the image. Browsers may reuse it for a few minutes
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "dashboard.html"), encoding="utf-8") as _template:
+    _DASHBOARD = _template.read()
+_DASHBOARD_CACHE_CONTROL = "public, max-age=300"
+
+# Statistics of the last stats poll, with the ETag of the aggregate they were computed from
+_STATS = None
+
+# Maximum number of blob downloads in flight at the same time, and number of blob
+# names fetched per listing page
+_MAX_DOWNLOADS = 32
+_LIST_PAGE_SIZE = 500
+
+# Rolling aggregate of the scores of every analyzed message, stored as one JSON record
+# per line. The message text is left out, it is never read back. New records are appended by analyze_sentiment to numbered append blob segments, a new segment
+# is started when the current one reaches the limit of 50,000 appends. The messages analyzed
+# before the first segment was created are copied once into a separate seed blob. Only the
+# scores are parsed back
+_AGGREGATE_CONTAINER = "aggregates"
+_AGGREGATE_SEGMENT = "records-{:05d}.ndjson"
+_AGGREGATE_SEGMENT_PREFIX = "records-"
+_RE_AGGREGATE_SEGMENT = re.compile(r"^records-(\d+)\.ndjson$")
+_AGGREGATE_SEED = "seed.ndjson"
+_AGGREGATE_SCHEMA = pa.schema([("sentiment", pa.float64()), ("subjectivity", pa.float64())])
+_AGGREGATE_PARSE_OPTIONS = pj.ParseOptions(explicit_schema=_AGGREGATE_SCHEMA, unexpected_field_behavior="ignore")
+# Index of the segment this worker appends to, found by listing the container on first use
+_SEGMENT = None
+
+# The figure is created once and redrawn by every update_visualization call,
+# the colorbar is added on the first draw and updated afterwards
+_FIG, _AX = plt.subplots(figsize=(10, 6))
+_FIG.subplots_adjust(left=0.08, right=0.98, bottom=0.1, top=0.9)
+_CBAR = None
+
+# Above this many messages the scatter plot is replaced by a hexbin density plot,
+# whose cost depends on the number of bins instead of the number of points
+_HEXBIN_THRESHOLD = 2000
+_HEXBIN_GRIDSIZE = 50
+
+# The PNG is written into the same buffer on every render, which keeps its allocation
+_PLOT_BUF = io.BytesIO()
+
+# The visualization is re-rendered on a schedule, skipping runs where the aggregate
+# still has the ETag of the last rendered version
+_RENDER_SCHEDULE = "0 */1 * * * *"
+_RENDERED_ETAG = None
+
+# Pattern sentiment lexicon shipped with TextBlob, loaded once per worker by _load_lexicon
+_LEXICON_PATH = os.path.join(os.path.dirname(textblob.__file__), "en", "en-sentiment.xml")
+_NEGATIONS = ("no", "not", "n't", "never")
+_PUNCTUATION = ".,;:!?()[]{}`''\"@#$^&*+-|=~_"
+_LEADING_PUNCTUATION = tuple(_PUNCTUATION.replace(".", ""))
+_TRAILING_PUNCTUATION = tuple(_PUNCTUATION)
+_RE_QUOTES = re.compile("[\u201c\u201d\u2018\u2019'\"]")
+_RE_SARCASM = re.compile(r"\( ?! ?\)")
+
+# Words ending with a period that the tokenizer keeps whole, matched case-sensitively:
+# common abbreviations, single letters ("T."), initials ("U.S.") and a capital followed
+# by consonants ("Mr.", "Ok.")
+_ABBREVIATIONS = frozenset((
+    "a.", "adj.", "adv.", "al.", "a.m.", "c.", "cf.", "comp.", "conf.", "def.", "ed.",
+    "e.g.", "esp.", "etc.", "ex.", "f.", "fig.", "gen.", "id.", "i.e.", "int.", "l.",
+    "m.", "Med.", "Mil.", "Mr.", "n.", "n.q.", "orig.", "pl.", "pred.", "pres.",
+    "p.m.", "ref.", "v.", "vs.", "w/"
+))
+_RE_ABBREVIATION = re.compile(r"^(?:([A-Za-z]\.)+|[A-Z][bcdfghjklmnpqrstvwxz|]+.)$")
+
+# Two or more line breaks end a sentence, the marker is dropped once the sentences are split
+_RE_LINEBREAKS = re.compile(r"\n{2,}")
+_EOS = "END-OF-SENTENCE"
+_SENTENCE_END = ("...", ".", "!", "?", _EOS)
+_SENTENCE_TAIL = ("'", '"', "\u201d", "\u2019", "...", ".", "!", "?", ")", _EOS)
+
+# Emoticons scored by the pattern analyzer, grouped by mood
+_EMOTICON_MOODS = (
+    (1.00, ("<3", "\u2665")),
+    (1.00, (">:D", ":-D", ":D", "=-D", "=D", "X-D", "x-D", "XD", "xD", "8-D")),
+    (0.75, (">:P", ":-P", ":P", ":-p", ":p", ":-b", ":b", ":c)", ":o)", ":^)")),
+    (0.50, (">:)", ":-)", ":)", "=)", "=]", ":]", ":}", ":>", ":3", "8)", "8-)")),
+    (0.25, (">;]", ";-)", ";)", ";-]", ";]", ";D", ";^)", "*-)", "*)")),
+    (0.05, (">:o", ":-O", ":O", ":o", ":-o", "o_O", "o.O", "\u00b0O\u00b0", "\u00b0o\u00b0")),
+    (-0.25, (">:/", ":-/", ":/", ":\\", ">:\\", ":-.", ":-s", ":s", ":S", ":-S", ">.>")),
+    (-0.75, (">:[", ":-(", ":(", "=(", ":-[", ":[", ":{", ":-<", ":c", ":-c", "=/")),
+    (-1.00, (":'(", ":'''(", ";'(")),
+)
+# Faces are joined case-sensitively but scored in lowercase, so when two moods collide the
+# first one listed wins
+_EMOTICONS = {face.lower(): polarity for polarity, faces in reversed(_EMOTICON_MOODS) for face in faces}
+_RE_EMOTICONS = re.compile(r"(%s)($|\s)" % "|".join(" ?".join(map(re.escape, face)) for _, faces in _EMOTICON_MOODS for face in faces))
+
+# Messages without any word character are neutral unless they contain an emoticon or a
+# sarcasm mark. The tokenizer only splits a message on whitespace, so these can only be
+# formed where their characters follow each other with at most whitespace in between
+_RE_TRIVIAL = re.compile(r"^[\W_]*$")
+_RE_FACES = re.compile("|".join(r"\s*".join(map(re.escape, face)) for face in (*_EMOTICONS, "(!)")))
+
+'''
+Return a shared blob service client, creating it on first use.
+@params:
+    small_blobs: bool - Whether the client is used to read blobs of a few kilobytes.
+@returns:
+    BlobServiceClient - The client connected to the function's storage account.
+'''
+def _bsc(small_blobs: bool = False) -> BlobServiceClient:
+    if small_blobs not in _BSC:
+        options = {}
+        if small_blobs:
+            options = {"max_single_get_size": _SMALL_BLOB_GET_SIZE, "max_chunk_get_size": _SMALL_BLOB_GET_SIZE}
+        _BSC[small_blobs] = BlobServiceClient.from_connection_string(os.environ["AzureWebJobsStorage"], **options)
+    return _BSC[small_blobs]
+
+'''
+Return the cached container client for the given container.
+@params:
+    name: str - The name of the container.
+    small_blobs: bool - Whether the container is read through the small blob client.
+@returns:
+    ContainerClient - The client for the container.
+'''
+def _container(name: str, small_blobs: bool = False) -> ContainerClient:
+    if (name, small_blobs) not in _CONTAINERS:
+        _CONTAINERS[name, small_blobs] = _bsc(small_blobs).get_container_client(name)
+    return _CONTAINERS[name, small_blobs]
+
+'''
+Return the cached client for a single, well-known blob. Blobs that are enumerated are
+downloaded through their container client instead.
+@params:
+    container: str - The name of the container.
+    name: str - The name of the blob.
+@returns:
+    BlobClient - The client for the blob.
+'''
+def _blob(container: str, name: str) -> BlobClient:
+    if (container, name) not in _BLOBS:
+        _BLOBS[container, name] = _container(container).get_blob_client(name)
+    return _BLOBS[container, name]
+
+'''
+Download and parse every JSON blob in a container. The blob names are streamed page by
+page into a queue, so the downloads start as soon as the first page is listed and
+overlap the round-trips to the storage account.
+@params:
+    container_client: ContainerClient - The client for the container to read.
+    created_before: datetime - If given, only the blobs created before this time are read.
+@returns:
+    list - The parsed content of each blob, in no particular order.
+'''
+async def _read_records(container_client: ContainerClient, created_before: datetime = None) -> list:
+    queue = asyncio.Queue(maxsize=_LIST_PAGE_SIZE)
+    records = []
+
+    async def list_names():
+        async for page in container_client.list_blobs(results_per_page=_LIST_PAGE_SIZE).by_page():
+            async for blob in page:
+                if created_before is None or blob.creation_time < created_before:
+                    await queue.put(blob.name)
+        # One end marker per consumer
+        for _ in range(_MAX_DOWNLOADS):
+            await queue.put(None)
+
+    async def download_and_parse():
+        while (name := await queue.get()) is not None:
+            downloader = await container_client.download_blob(name)
+            records.append(orjson.loads(await downloader.readall()))
+
+    tasks = [asyncio.ensure_future(list_names())]
+    tasks += [asyncio.ensure_future(download_and_parse()) for _ in range(_MAX_DOWNLOADS)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Stop the remaining tasks if one of them failed
+        for task in tasks:
+            task.cancel()
+    return records
+
+'''
+Build a read-only SAS URL for a blob. The expiry is rounded to the hour so the URL stays
+the same between page refreshes, and the browser is told to revalidate its cached copy
+with the storage account instead of downloading the image again.
+@params:
+    blob_client: BlobClient - The client for the blob to link to.
+@returns:
+    str - The SAS URL, or None if the connection has no account key to sign it with.
+'''
+def _sas_url(blob_client: BlobClient) -> str:
+    account_key = getattr(blob_client.credential, "account_key", None)
+    if not account_key:
+        return None
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    sas = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=hour + timedelta(hours=1) + _SAS_VALIDITY,
+        cache_control="no-cache",
+        content_type="image/png"
+    )
+    return f"{blob_client.url}?{sas}"
+
+'''
+Serialize the scores of a sentiment record as one line of the rolling aggregate.
+@params:
+    record: dict - The sentiment details of a message.
+@returns:
+    bytes - The JSON line holding the sentiment and subjectivity scores.
+'''
+def _aggregate_line(record: dict) -> bytes:
+    return orjson.dumps({"sentiment": record.get("sentiment", 0.0), "subjectivity": record.get("subjectivity", 0.0)}) + b"\n"
+
+'''
+Append a sentiment record to the rolling aggregate. Appends are atomic, so concurrent
+invocations never overwrite each other. The segment is created on the first append, and
+once it holds 50,000 appends the record goes to the next segment.
+@params:
+    record: dict - The sentiment details of the new message.
+@returns:
+    None
+'''
+async def _append_to_aggregate(record: dict) -> None:
+    global _SEGMENT
+    if _SEGMENT is None:
+        segments = await _aggregate_segments()
+        _SEGMENT = _segment_index(segments[-1]) if segments else 0
+    line = _aggregate_line(record)
+    while True:
+        blob_client = _blob(_AGGREGATE_CONTAINER, _AGGREGATE_SEGMENT.format(_SEGMENT))
+        try:
+            await blob_client.append_block(line)
+            return
+        except ResourceNotFoundError:
+            # First append to this segment
+            await _create_segment(blob_client)
+        except HttpResponseError as e:
+            if e.error_code != "BlockCountExceedsLimit":
+                raise
+            # The segment is full, move on to the next one
+            _SEGMENT += 1
+
+'''
+Create an empty aggregate segment, and the container if needed. Does nothing if the
+segment was already created, for example by a concurrent invocation.
+@params:
+    blob_client: BlobClient - The client for the segment.
+@returns:
+    None
+'''
+async def _create_segment(blob_client: BlobClient) -> None:
+    try:
+        await _container(_AGGREGATE_CONTAINER).create_container()
+    except ResourceExistsError:
+        pass
+    try:
+        await blob_client.create_append_blob(match_condition=MatchConditions.IfMissing)
+    except ResourceExistsError:
+        pass
+
+'''
+Return the properties of a blob without downloading it.
+@params:
+    blob_client: BlobClient - The client for the blob.
+@returns:
+    BlobProperties - The properties of the blob, or None if the blob does not exist.
+'''
+async def _properties(blob_client: BlobClient):
+    try:
+        return await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+
+'''
+Return the index of an aggregate segment.
+@params:
+    segment: BlobProperties - The properties of the segment.
+@returns:
+    int - The index in the name of the segment.
+'''
+def _segment_index(segment) -> int:
+    return int(_RE_AGGREGATE_SEGMENT.match(segment.name).group(1))
+
+'''
+List the segments of the rolling aggregate in order. Other blobs in the container, such
+as the seed, are left out.
+@returns:
+    list - The properties of each segment, empty if there is no aggregate yet.
+'''
+async def _aggregate_segments() -> list:
+    try:
+        blobs = _container(_AGGREGATE_CONTAINER).list_blobs(name_starts_with=_AGGREGATE_SEGMENT_PREFIX)
+        return sorted([b async for b in blobs if _RE_AGGREGATE_SEGMENT.match(b.name)], key=_segment_index)
+    except ResourceNotFoundError:
+        return []
+
+'''
+List the blobs of the rolling aggregate, the segments in order followed by the seed.
+@returns:
+    list - The properties of each blob, empty if there is no aggregate yet.
+'''
+async def _aggregate_blobs() -> list:
+    segments, seed = await asyncio.gather(_aggregate_segments(), _properties(_blob(_AGGREGATE_CONTAINER, _AGGREGATE_SEED)))
+    return segments + [seed] if seed is not None else segments
+
+'''
+Return a version of the rolling aggregate that changes whenever a record is added, built
+from the ETags of its blobs.
+@params:
+    blobs: list - The properties of the aggregate blobs, as listed by _aggregate_blobs.
+@returns:
+    str - The version of the aggregate, or None if there is no aggregate yet.
+'''
+def _aggregate_version(blobs: list) -> str:
+    if not blobs:
+        return None
+    return hashlib.sha1("|".join(f"{b.name}:{b.etag}" for b in blobs).encode("utf-8")).hexdigest()
+
+'''
+Copy the messages analyzed before the first segment was created into the seed blob,
+creating the first segment if no message was appended yet. The seed is uploaded in one
+piece and never overwritten, so it is either complete or missing, and a failed attempt is
+simply retried by the next call. Messages analyzed after the first segment was created
+are appended to the segments and not copied again.
+@params:
+    blobs: list - The properties of the aggregate blobs, as listed by _aggregate_blobs.
+@returns:
+    bool - Whether the seed was created by this call.
+'''
+async def _seed_aggregate(blobs: list) -> bool:
+    names = {b.name: b for b in blobs}
+    if _AGGREGATE_SEED in names:
+        return False
+    try:
+        first_segment = names.get(_AGGREGATE_SEGMENT.format(0))
+        if first_segment is None:
+            blob_client = _blob(_AGGREGATE_CONTAINER, _AGGREGATE_SEGMENT.format(0))
+            await _create_segment(blob_client)
+            first_segment = await blob_client.get_blob_properties()
+        records = await _read_records(_container("text-analyzed", small_blobs=True), created_before=first_segment.creation_time)
+        await _blob(_AGGREGATE_CONTAINER, _AGGREGATE_SEED).upload_blob(b"".join(map(_aggregate_line, records)))
+    except ResourceExistsError:
+        # Seeded by a concurrent invocation
+        return False
+    except Exception as e:
+        logging.error(f"Error seeding the aggregate, it is missing the earlier messages until the next attempt: {str(e)}")
+        return False
+    logging.info(f"Seeded the aggregate with {len(records)} earlier messages")
+    return True
+
+'''
+Parse the records of the rolling aggregate in a single batched call by the pyarrow JSON
+reader. This is CPU-bound, so it is run on a worker thread.
+@params:
+    content: bytes - The concatenated content of the aggregate blobs.
+@returns:
+    tuple - The sentiment and subjectivity scores, as two NumPy arrays.
+'''
+def _parse_aggregate(content: bytes) -> tuple:
+    if not content:
+        return np.empty(0), np.empty(0)
+    try:
+        table = pj.read_json(io.BytesIO(content), parse_options=_AGGREGATE_PARSE_OPTIONS)
+    except pa.ArrowInvalid:
+        # Segments written before the message text was left out can hold a line longer than
+        # a parse block, read those in a single block
+        table = pj.read_json(io.BytesIO(content), read_options=pj.ReadOptions(block_size=len(content)), parse_options=_AGGREGATE_PARSE_OPTIONS)
+    return (
+        table.column("sentiment").fill_null(0.0).to_numpy(),
+        table.column("subjectivity").fill_null(0.0).to_numpy()
+    )
+
+'''
+Read the scores of every analyzed message from the rolling aggregate. The blobs are
+downloaded concurrently and parsed on a worker thread, so the event loop keeps serving
+other invocations.
+@params:
+    blobs: list - The properties of the aggregate blobs, as listed by _aggregate_blobs.
+@returns:
+    tuple - The sentiment and subjectivity scores, as two NumPy arrays.
+'''
+async def _read_aggregate(blobs: list) -> tuple:
+    async def download(name):
+        downloader = await _blob(_AGGREGATE_CONTAINER, name).download_blob()
+        return await downloader.readall()
+
+    content = b"".join(await asyncio.gather(*(download(b.name) for b in blobs)))
+    return await asyncio.to_thread(_parse_aggregate, content)
+
+'''
+Load the pattern sentiment lexicon into a flat dictionary. The scores of all the senses
+of a word are averaged the same way the pattern analyzer does it.
+@returns:
+    dict - (polarity, subjectivity, intensity, is_modifier) for each word, or None if
+    the lexicon file is not available.
+'''
+def _load_lexicon():
+    if not os.path.exists(_LEXICON_PATH):
+        return None
+    senses = {}
+    for word in ET.parse(_LEXICON_PATH).getroot().findall("word"):
+        form = word.attrib.get("form")
+        if form:
+            senses.setdefault(form, {}).setdefault(word.attrib.get("pos"), []).append((
+                float(word.attrib.get("polarity", 0.0)),
+                float(word.attrib.get("subjectivity", 0.0)),
+                float(word.attrib.get("intensity", 1.0))
+            ))
+    lexicon = {}
+    adjectives = {}
+    for form, by_pos in senses.items():
+        # Average the senses per part-of-speech tag, then the tags
+        per_pos = {pos: np.mean(psi, axis=0) for pos, psi in by_pos.items()}
+        p, s, i = np.mean(list(per_pos.values()), axis=0)
+        lexicon[form] = (float(p), float(s), float(i), "RB" in by_pos)
+        if "JJ" in per_pos:
+            adjectives[form] = per_pos["JJ"]
+    # Score the adverb of each adjective like the adjective ("terrible" to "terribly")
+    for form, (p, s, i) in adjectives.items():
+        if form.endswith("y"):
+            form = form[:-1] + "i"
+        if form.endswith("le"):
+            form = form[:-2]
+        lexicon[form + "ly"] = (float(p), float(s), float(i), True)
+    return lexicon
+
+_LEXICON = _load_lexicon()
+
+'''
+Split a message into the lowercase tokens the pattern analyzer assesses. This follows the
+TextBlob tokenizer: "n't" is split from the word it ends, punctuation and quotes are split
+from the words unless the word is an abbreviation, and emoticons and the sarcasm mark (!)
+are joined back together within each sentence.
+@params:
+    message: str - The text message.
+@returns:
+    list - The tokens of the message.
+'''
+def _tokenize(message: str) -> list:
+    text = _RE_QUOTES.sub(r" \g<0> ", message.replace("n't", " n't")).replace("\r\n", "\n")
+    tokens = []
+    for t in _RE_LINEBREAKS.sub(" %s " % _EOS, text).split():
+        tail = []
+        while t.startswith(_LEADING_PUNCTUATION):
+            tokens.append(t[0])
+            t = t[1:]
+        while t.endswith(_TRAILING_PUNCTUATION):
+            if t.endswith(_LEADING_PUNCTUATION):
+                tail.append(t[-1])
+                t = t[:-1]
+            # Split an ellipsis before a period
+            if t.endswith("..."):
+                tail.append("...")
+                t = t[:-3].rstrip(".")
+            if t.endswith("."):
+                if t in _ABBREVIATIONS or _RE_ABBREVIATION.match(t):
+                    break
+                tail.append(".")
+                t = t[:-1]
+        if t:
+            tokens.append(t)
+        tokens.extend(reversed(tail))
+
+    # Split the sentences after their final punctuation, closing quotes and parentheses
+    sentences = []
+    i = j = 0
+    while j < len(tokens):
+        if tokens[j] in _SENTENCE_END:
+            while j < len(tokens) and tokens[j] in _SENTENCE_TAIL and tokens[j] not in ("'", '"'):
+                j += 1
+            sentences.append([t for t in tokens[i:j] if t != _EOS])
+            i = j
+        j += 1
+    sentences.append(tokens[i:j])
+
+    # Join the punctuation marks back into the emoticons and sarcasm marks they form
+    text = " ".join(
+        _RE_EMOTICONS.sub(lambda m: m.group(1).replace(" ", "") + m.group(2), _RE_SARCASM.sub("(!)", " ".join(sentence)))
+        for sentence in sentences if sentence
+    )
+    return text.lower().split()
+
+'''
+Score a message against the lexicon. This follows the pattern analyzer used by TextBlob:
+known words are averaged, a preceding adverb scales the next word by its intensity,
+a negation halves and flips the polarity and exclamation marks boost the previous word.
+Messages with no word character and no emoticon are neutral, and a single word is looked
+up directly, without tokenizing. Falls back to TextBlob when the lexicon could not be loaded.
+@params:
+    message: str - The text message.
+@returns:
+    tuple - The polarity (-1.0 to 1.0) and subjectivity (0.0 to 1.0) of the message.
+'''
+def _score(message: str) -> tuple:
+    if _RE_TRIVIAL.match(message) and not _RE_FACES.search(message.lower()):
+        return 0.0, 0.0
+    if _LEXICON is None:
+        sentiment = TextBlob(message).sentiment
+        return sentiment.polarity, sentiment.subjectivity
+
+    words = message.split()
+    if len(words) == 1 and words[0].isalpha():
+        entry = _LEXICON.get(words[0].lower())
+        return (entry[0], entry[1]) if entry is not None else (0.0, 0.0)
+
+    # Each assessment is [polarity, subjectivity, intensity, negated]
+    assessments = []
+    modifier = None
+    negation = None
+    for w in _tokenize(message):
+        entry = _LEXICON.get(w)
+        if entry is not None:
+            p, s, i, is_modifier = entry
+            if modifier is None:
+                assessments.append([p, s, i, False])
+            else:
+                # Known word preceded by a modifier ("really good")
+                last = assessments[-1]
+                last[0] = max(-1.0, min(p * last[2], 1.0))
+                last[1] = max(-1.0, min(s * last[2], 1.0))
+                last[2] = i
+            if negation is not None:
+                # Known word preceded by a negation ("not really good")
+                assessments[-1][2] = 1.0 / assessments[-1][2]
+                assessments[-1][3] = True
+            modifier = w if is_modifier else None
+            negation = w if w in _NEGATIONS else None
+            continue
+
+        if w in _NEGATIONS:
+            negation = w
+        elif negation and len(w.strip("'")) > 1:
+            # Retain the negation only across small words ("not a good")
+            negation = None
+        if negation is not None and modifier is not None and modifier.endswith("ly"):
+            # Negation preceded by a modifier ("really not good")
+            assessments[-1][3] = True
+            negation = None
+        elif modifier and len(w) > 2:
+            # Retain the modifier only across small words ("really is a good")
+            modifier = None
+        if w == "!" and assessments:
+            assessments[-1][0] = max(-1.0, min(assessments[-1][0] * 1.25, 1.0))
+        if w == "(!)":
+            assessments.append([0.0, 1.0, 1.0, False])
+        if not w.isalpha() and w in _EMOTICONS:
+            assessments.append([_EMOTICONS[w], 1.0, 1.0, False])
+
+    if not assessments:
+        return 0.0, 0.0
+    polarity = sum(p * -0.5 if negated else p for p, _, _, negated in assessments) / len(assessments)
+    subjectivity = sum(s for _, s, _, _ in assessments) / len(assessments)
+    return polarity, subjectivity
+
 '''
 The first function is used to save the text messages to a 
 blob storage. This blob storage is then used by the second function to 
@@ -56,11 +635,11 @@ def get_messages(req: func.HttpRequest, outputBlob : func.Out[str]) -> func.Http
 
 '''
 The second function is used to perform sentiment analysis on the text messages
-that are saved to the blob storage. The sentiment analysis results are then saved to
-a new blob storage.
+that are saved to the blob storage. The sentiment analysis results are appended to the
+rolling aggregate and then saved to a new blob storage.
 @params:
     myblob: func.InputStream - The input binding to the blob that triggered the function.
-    outputBlob: func.Out[str] - The output binding to save the sentiment analysis results.
+    outputBlob: func.Out[bytes] - The output binding to save the sentiment analysis results.
 @returns:
     func.HttpResponse - The HTTP response object.
 '''
@@ -68,7 +647,7 @@ a new blob storage.
 @app.blob_trigger(arg_name="myblob", path="text-message",connection="AzureWebJobsStorage")
 @app.blob_output(arg_name="outputBlob", path="text-analyzed/{rand-guid}.txt", connection="AzureWebJobsStorage")
 
-def analyze_sentiment(myblob: func.InputStream, outputBlob : func.Out[str]) -> func.HttpResponse:
+async def analyze_sentiment(myblob: func.InputStream, outputBlob : func.Out[bytes]) -> func.HttpResponse:
     logging.info(f" Starting to analyze the sentiment of the blob {myblob.name}")
     # Read the message from the blob
     try:
@@ -76,9 +655,7 @@ def analyze_sentiment(myblob: func.InputStream, outputBlob : func.Out[str]) -> f
         logging.info(f"Message: {message}")
 
         # Perform sentiment analysis by getting the sentiment and subjectivity
-        blob = TextBlob(message)
-        sentiment = blob.sentiment.polarity
-        subjectivity = blob.sentiment.subjectivity
+        sentiment, subjectivity = _score(message)
         logging.info(f"Sentiment: {sentiment}")
         
         # Display the sentiment
@@ -95,10 +672,16 @@ def analyze_sentiment(myblob: func.InputStream, outputBlob : func.Out[str]) -> f
             "sentiment": sentiment,
             "sentiment_label": sentiment_label,
             "subjectivity": subjectivity,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "timestamp": datetime.now().isoformat(sep=" ", timespec="seconds")
         }
-        outputBlob.set(json.dumps(results, indent=2))
+        outputBlob.set(orjson.dumps(results, option=orjson.OPT_INDENT_2))
         logging.info(f"Sentiment analysis details are saved to the blob!")
+
+        # Add the record to the rolling aggregate, the output blob is saved even if this fails
+        try:
+            await _append_to_aggregate(results)
+        except Exception as e:
+            logging.error(f"Error appending to the aggregate: {e}")
     
     # Handle exceptions
     except Exception as e:
@@ -106,85 +689,112 @@ def analyze_sentiment(myblob: func.InputStream, outputBlob : func.Out[str]) -> f
         return func.HttpResponse(f"Error: {e}", status_code=500)
     return None
 
+'''
+Draw the sentiment and subjectivity scores on the shared figure, as a scatter plot or as a
+hexbin density plot for many messages, and encode it as a PNG. This is CPU-bound, so it is
+run on a worker thread.
+@params:
+    sentiment: np.ndarray - The sentiment score of every message.
+    subjectivity: np.ndarray - The subjectivity score of every message.
+@returns:
+    bytes - The PNG image.
+'''
+def _render(sentiment: np.ndarray, subjectivity: np.ndarray) -> bytes:
+    global _CBAR
+    # Generate a visualization (Scatter plot, or hexbin for many messages) on the shared figure
+    _AX.clear()
+    if sentiment.size > _HEXBIN_THRESHOLD:
+        plot = _AX.hexbin(
+            sentiment,
+            subjectivity,
+            gridsize=_HEXBIN_GRIDSIZE,
+            extent=(-1, 1, 0, 1),
+            mincnt=1,
+            cmap='viridis'
+        )
+        colorbar_label = 'Number of Messages'
+    else:
+        plot = _AX.scatter(
+            sentiment, 
+            subjectivity,
+            c=sentiment,  
+            cmap='viridis', 
+            alpha=0.6,
+            s=100  
+        )
+        colorbar_label = 'Sentiment Score'
+    # Add labels and title
+    _AX.set_title("Sentiment Analysis Results", fontsize=14, pad=20)
+    _AX.set_xlabel("Sentiment Score", fontsize=12)
+    _AX.set_ylabel("Subjectivity Score", fontsize=12)
+    
+    # Add reference lines
+    _AX.axhline(y=0.5, color='gray', linestyle='--', alpha=0.3)
+    _AX.axvline(x=0, color='gray', linestyle='--', alpha=0.3)
+    
+    # Add grid and colorbar
+    _AX.grid(True, alpha=0.3)
+    if _CBAR is None:
+        _CBAR = _FIG.colorbar(plot, ax=_AX, label=colorbar_label)
+    else:
+        _CBAR.update_normal(plot)
+        _CBAR.set_label(colorbar_label)
+    
+    # Save the visualization into the shared buffer
+    _PLOT_BUF.seek(0)
+    _PLOT_BUF.truncate()
+    _FIG.savefig(_PLOT_BUF, format='png', dpi=100)
+    return _PLOT_BUF.getvalue()
+
 '''
 The third function is used to update the visualization of the sentiment analysis results
-based on the sentiment and subjectivity scores of the text messages. The visualization
-is saved to a new blob storage.
+based on the sentiment and subjectivity scores of the text messages. It runs once a minute,
+so messages arriving in bursts are batched into a single render, and it does nothing when
+the rolling aggregate has not changed since the last render. The visualization is saved
+to a new blob storage.
 @params:
-    myblob: func.InputStream - The input binding to the blob that triggered the function.
+    timer: func.TimerRequest - The timer that triggered the function.
     vsBlob: func.Out[str] - The output binding to save the visualization.
 @returns:
     None
 '''
 
 @app.function_name("update_visualization")
-@app.blob_trigger(arg_name="myblob", path="text-analyzed", connection="AzureWebJobsStorage")
+@app.schedule(schedule=_RENDER_SCHEDULE, arg_name="timer", run_on_startup=False)
 @app.blob_output(arg_name="vsBlob", path="graphs/sentiment_analysis.png", connection="AzureWebJobsStorage")
 
-def update_visualization(myblob: func.InputStream, vsBlob: func.Out[str]) -> None:
-    logging.info(f"Updating the sentiment visualization with the new blob {myblob.name}")
-    # connect to the blob storage to get the sentiment details
+async def update_visualization(timer: func.TimerRequest, vsBlob: func.Out[str]) -> None:
+    global _RENDERED_ETAG
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(os.environ["AzureWebJobsStorage"])
-        container_client = blob_service_client.get_container_client("text-analyzed")
-        
-        # Get the list of blobs in the container
-        blobs = container_client.list_blobs()
-        
-        # Get the sentiment details from the blobs
-        data_points = []
-        
-        # Collect all the sentiment details from the blobs present in the container
-        for blob in blobs:
-            blob_client = container_client.get_blob_client(blob)
-            content = blob_client.download_blob().readall()
-            # Load the JSON data
-            data = json.loads(content)
-            
-            # Add error checking and logging
-            logging.info(f"Processing blob data: {data}")
-            
-            # Append the sentiment details to the data_points list
-            data_points.append({
-                'sentiment': float(data.get('sentiment', 0)), 
-                'subjectivity': float(data.get('subjectivity', 0)),
-                'message': data.get('message', '')
-            })
-
-        # Create a data frame from the sentiment details
-        df = pd.DataFrame(data_points)
-        
-        # Generate a visualization (Scatter plot)
-        plt.figure(figsize=(10, 6))
-        scatter = plt.scatter(
-            df['sentiment'], 
-            df['subjectivity'],
-            c=df['sentiment'],  
-            cmap='viridis', 
-            alpha=0.6,
-            s=100  
-        )
-        # Add labels and title
-        plt.title("Sentiment Analysis Results", fontsize=14, pad=20)
-        plt.xlabel("Sentiment Score", fontsize=12)
-        plt.ylabel("Subjectivity Score", fontsize=12)
-        
-        # Add reference lines
-        plt.axhline(y=0.5, color='gray', linestyle='--', alpha=0.3)
-        plt.axvline(x=0, color='gray', linestyle='--', alpha=0.3)
-        
-        # Add grid and colorbar
-        plt.grid(True, alpha=0.3)
-        plt.colorbar(scatter, label='Sentiment Score')
+        # Seed the aggregate with the earlier messages if that was not done yet
+        blobs = await _aggregate_blobs()
+        if await _seed_aggregate(blobs):
+            blobs = await _aggregate_blobs()
+
+        # Skip the render if no message was analyzed since the last one
+        etag = _aggregate_version(blobs)
+        if etag is None:
+            logging.info("No sentiment records to visualize yet")
+            return
+        if etag == _RENDERED_ETAG:
+            logging.info("Sentiment records unchanged, skipping the visualization update")
+            return
+        logging.info("Updating the sentiment visualization")
+
+        # Get the sentiment details of every message from the aggregate
+        sentiment, subjectivity = await _read_aggregate(blobs)
+        if not sentiment.size:
+            logging.info("No sentiment records to visualize yet")
+            _RENDERED_ETAG = etag
+            return
+        logging.info(f"Processing {sentiment.size} sentiment records")
         
-        # Save the visualization into a buffer
-        plot_buf = io.BytesIO()
-        plt.savefig(plot_buf, format='png', bbox_inches='tight', dpi=300)
-        plot_buf.seek(0)
+        # Render on a worker thread, the timer is a singleton so only one render uses the figure
+        png = await asyncio.to_thread(_render, sentiment, subjectivity)
 
         # Save the plot to the output blob
-        vsBlob.set(plot_buf.getvalue())
-        plt.close()
+        vsBlob.set(png)
+        _RENDERED_ETAG = etag
         
         logging.info("Visualization updated successfully!")
         
@@ -195,9 +805,37 @@ def update_visualization(myblob: func.InputStream, vsBlob: func.Out[str]) -> Non
     return
 
 '''
-The fourth function is used to display the visualization of the sentiment analysis results
-based on the sentiment and subjectivity scores of the text messages. The visualization
-is displayed as an HTML page.
+Compute the dashboard statistics from the sentiment and subjectivity scores.
+@params:
+    sentiment: np.ndarray - The sentiment score of every message.
+    subjectivity: np.ndarray - The subjectivity score of every message.
+@returns:
+    dict - The number of messages, the averages and the count of each sentiment.
+'''
+def _compute_stats(sentiment: np.ndarray, subjectivity: np.ndarray) -> dict:
+    if not sentiment.size:
+        return {
+            'total_messages': 0,
+            'average_sentiment': 0.0,
+            'positive_count': 0,
+            'negative_count': 0,
+            'neutral_count': 0,
+            'average_subjectivity': 0.0
+        }
+    return {
+        'total_messages': int(sentiment.size),
+        'average_sentiment': float(sentiment.mean()),
+        'positive_count': int((sentiment > 0).sum()),
+        'negative_count': int((sentiment < 0).sum()),
+        'neutral_count': int((sentiment == 0).sum()),
+        'average_subjectivity': float(subjectivity.mean())
+    }
+
+
+'''
+The fourth function is used to display the dashboard of the sentiment analysis results.
+The page is static, its script polls the stats function every 5 seconds and fills in
+the statistics and the visualization.
 @params:
     req: func.HttpRequest - The HTTP request object.
 @returns:
@@ -205,192 +843,79 @@ is displayed as an HTML page.
 '''
 @app.route(route="view_visualization", auth_level=func.AuthLevel.ANONYMOUS)
 def view_visualization(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(
+        _DASHBOARD,
+        mimetype="text/html",
+        status_code=200,
+        headers={"Cache-Control": _DASHBOARD_CACHE_CONTROL}
+    )
+
+'''
+The fifth function returns the dashboard statistics and the link to the visualization
+as JSON. The ETag is derived from the ETags of the aggregate and of the image, so a
+poll sending a matching If-None-Match header is answered with 304 after two metadata
+requests, without downloading anything.
+@params:
+    req: func.HttpRequest - The HTTP request object.
+@returns:
+    func.HttpResponse - The HTTP response object.
+'''
+@app.route(route="stats", auth_level=func.AuthLevel.ANONYMOUS)
+async def get_stats(req: func.HttpRequest) -> func.HttpResponse:
+    global _STATS
 
     try:
-        # Connect to blob storage
-        blob_service_client = BlobServiceClient.from_connection_string(os.environ["AzureWebJobsStorage"])
-        
-        # Get the text-analyzed from the container to calculate statistics
-        rec_container = blob_service_client.get_container_client("text-analyzed")
-        data_points = []
-
-        # Collect all text-analyzed
-        for blob in rec_container.list_blobs():
-            blob_client = rec_container.get_blob_client(blob)
-            content = blob_client.download_blob().readall()
-            data = json.loads(content)
-            data_points.append({
-                'sentiment': float(data.get('sentiment', 0)),
-                'subjectivity': float(data.get('subjectivity', 0)),
-                'message': data.get('message', ''),
-                'timestamp': data.get('timestamp', '')
-            })
-
-        # Create a DataFrame only if we have data
-        if data_points:
-            df = pd.DataFrame(data_points)
-            stats = {
-                'total_messages': len(df),
-                'average_sentiment': float(df['sentiment'].mean()),
-                'positive_count': int((df['sentiment'] > 0).sum()),
-                'negative_count': int((df['sentiment'] < 0).sum()),
-                'neutral_count': int((df['sentiment'] == 0).sum()),
-                'average_subjectivity': float(df['subjectivity'].mean())
-            }
+        vis_blob = _blob("graphs", "sentiment_analysis.png")
+        blobs, image = await asyncio.gather(_aggregate_blobs(), _properties(vis_blob))
+        aggregate_etag = _aggregate_version(blobs)
+        image_etag = image.etag if image is not None else None
+
+        # The SAS URL changes every hour, so it is part of the ETag as well
+        image_src = None
+        if image_etag is not None:
+            image_src = _sas_url(vis_blob)
+        image_key = image_src or image_etag
+        etag = '"%s"' % hashlib.sha1(f"{aggregate_etag}|{image_key}".encode("utf-8")).hexdigest()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+        if_none_match = req.headers.get("If-None-Match", "")
+        if etag in (tag.strip() for tag in if_none_match.split(",")):
+            return func.HttpResponse(status_code=304, headers=headers)
+
+        # Reuse the statistics of the last poll while the aggregate is unchanged
+        if _STATS is not None and _STATS[0] == aggregate_etag:
+            stats = _STATS[1]
+        elif aggregate_etag is None:
+            stats = _compute_stats(np.empty(0), np.empty(0))
+        else:
+            stats = _compute_stats(*await _read_aggregate(blobs))
+            _STATS = (aggregate_etag, stats)
+
+        # Link to the visualization image if it exists, versioned by its ETag so the
+        # browser only downloads it again after a new render
+        if image_src is not None:
+            visualization = image_src + "&v=" + quote(image_etag.strip('"'))
+        elif image_etag is not None:
+            # Without an account key the image can only be embedded in the response
+            downloader = await vis_blob.download_blob()
+            visualization = "data:image/png;base64," + base64.b64encode(await downloader.readall()).decode('utf-8')
         else:
-            stats = {
-                'total_messages': 0,
-                'average_sentiment': 0.0,
-                'positive_count': 0,
-                'negative_count': 0,
-                'neutral_count': 0,
-                'average_subjectivity': 0.0
-            }
-
-        # Try to get the visualization image if it exists
-        vis_container = blob_service_client.get_container_client("graphs")
-        try:
-            blob_client = vis_container.get_blob_client("sentiment_analysis.png")
-            image = blob_client.download_blob().readall()
-            encoded_image = base64.b64encode(image).decode('utf-8')
-            has_visualization = True
-        except Exception as e:
             logging.info("No visualization found yet")
-            has_visualization = False
-
-        # Create HTML content
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Sentiment Analysis Visualization</title>
-            <meta http-equiv="refresh" content="5">
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    margin: 0;
-                    padding: 20px;
-                    background-color: #f5f5f5;
-                }}
-                .container {{
-                    max-width: 1200px;
-                    margin: 0 auto;
-                    background-color: white;
-                    padding: 20px;
-                    border-radius: 8px;
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                }}
-                .stats-grid {{
-                    display: grid;
-                    grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                    gap: 20px;
-                    margin-bottom: 20px;
-                }}
-                .stat-box {{
-                    background-color: #f8f9fa;
-                    padding: 15px;
-                    border-radius: 4px;
-                    text-align: center;
-                }}
-                .stat-value {{
-                    font-size: 24px;
-                    font-weight: bold;
-                    color: #2c3e50;
-                }}
-                .stat-label {{
-                    color: #7f8c8d;
-                    margin-top: 5px;
-                }}
-                .visualization {{
-                    text-align: center;
-                    margin-top: 20px;
-                    padding: 20px;
-                    background-color: #f8f9fa;
-                    border-radius: 4px;
-                }}
-                .update-time {{
-                    text-align: right;
-                    color: #666;
-                    font-size: 0.9em;
-                    margin-top: 10px;
-                }}
-                h1 {{
-                    color: #2c3e50;
-                    text-align: center;
-                    margin-bottom: 30px;
-                }}
-                .message {{
-                    text-align: center;
-                    padding: 20px;
-                    color: #666;
-                    font-style: italic;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Real-time Sentiment Analysis Dashboard</h1>
-                
-                <div class="stats-grid">
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['total_messages']}</div>
-                        <div class="stat-label">Total Messages</div>
-                    </div>
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['average_sentiment']:.3f}</div>
-                        <div class="stat-label">Average Sentiment</div>
-                    </div>
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['positive_count']}</div>
-                        <div class="stat-label">Positive Messages</div>
-                    </div>
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['negative_count']}</div>
-                        <div class="stat-label">Negative Messages</div>
-                    </div>
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['neutral_count']}</div>
-                        <div class="stat-label">Neutral Messages</div>
-                    </div>
-                    <div class="stat-box">
-                        <div class="stat-value">{stats['average_subjectivity']:.3f}</div>
-                        <div class="stat-label">Average Subjectivity</div>
-                    </div>
-                </div>
-                
-                <div class="visualization">
-                    {f'<img src="data:image/png;base64,{encoded_image}" style="max-width: 100%; height: auto;" alt="Sentiment Analysis Visualization"/>' if has_visualization else '<div class="message">Waiting for data... Please submit some messages for analysis.</div>'}
-                </div>
-                
-                <div class="update-time">
-                    Last updated: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
+            visualization = None
+
         return func.HttpResponse(
-            html_content,
-            mimetype="text/html",
-            status_code=200
+            orjson.dumps({**stats, "visualization": visualization}),
+            mimetype="application/json",
+            status_code=200,
+            headers=headers
         )
-        
+
     except Exception as e:
-        logging.error(f"Error displaying visualization: {str(e)}")
+        logging.error(f"Error computing statistics: {str(e)}")
         return func.HttpResponse(
-            f"""
-            <html>
-                <body>
-                    <h1>Error</h1>
-                    <p>An error occurred while displaying the visualization: {str(e)}</p>
-                    <p>Please make sure you have submitted some messages for analysis.</p>
-                </body>
-            </html>
-            """,
-            mimetype="text/html",
+            f"An error occurred while computing the statistics: {str(e)}",
             status_code=500
-        )   
+        )
 
 
 '''
@@ -0,0 +1,90 @@
+# Tests of the rolling aggregate against an in-memory stand-in for the blob storage
+# Run from the project root with: python -m unittest discover test
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import orjson
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import function_app
+
+# Larger than the 1 MiB blocks the pyarrow JSON reader parses by default
+LARGE_MESSAGE = "x" * (2 * 1024 * 1024)
+
+
+class FakeBlob:
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    async def append_block(self, data):
+        if self.name not in self.store:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        self.store[self.name] += data
+
+    async def create_append_blob(self, match_condition=None):
+        if self.name in self.store:
+            raise ResourceExistsError("The specified blob already exists.")
+        self.store[self.name] = b""
+
+    async def download_blob(self):
+        content = self.store[self.name]
+
+        class Downloader:
+            async def readall(self):
+                return content
+        return Downloader()
+
+
+class FakeContainer:
+
+    async def create_container(self):
+        raise ResourceExistsError("The specified container already exists.")
+
+
+class TestAggregate(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.store = {}
+        for target, value in (
+            ("_blob", lambda container, name: FakeBlob(self.store, name)),
+            ("_container", lambda name, small_blobs=False: FakeContainer()),
+            ("_SEGMENT", 0),
+        ):
+            patcher = mock.patch.object(function_app, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def listed(self):
+        # The aggregate blobs as listed by _aggregate_blobs, the segments before the seed
+        return [SimpleNamespace(name=name) for name in sorted(self.store)]
+
+    async def test_large_message_is_not_stored(self):
+        await function_app._append_to_aggregate({"message": LARGE_MESSAGE, "sentiment": 0.5, "subjectivity": 0.25})
+        await function_app._append_to_aggregate({"message": "bad", "sentiment": -0.7, "subjectivity": 0.65})
+        segment = self.store[function_app._AGGREGATE_SEGMENT.format(0)]
+        self.assertLess(len(segment), 1024)
+
+        sentiment, subjectivity = await function_app._read_aggregate(self.listed())
+        self.assertEqual(sentiment.tolist(), [0.5, -0.7])
+        self.assertEqual(subjectivity.tolist(), [0.25, 0.65])
+
+    async def test_segment_with_record_larger_than_a_block(self):
+        # Segments written before the message text was left out hold the whole record
+        self.store[function_app._AGGREGATE_SEGMENT.format(0)] = (
+            orjson.dumps({"message": "fine", "sentiment": 0.1, "subjectivity": 0.2}) + b"\n"
+            + orjson.dumps({"message": LARGE_MESSAGE, "sentiment": 0.5, "subjectivity": 0.25}) + b"\n"
+        )
+        self.store[function_app._AGGREGATE_SEED] = b'{"sentiment": -1.0, "subjectivity": 1.0}\n'
+
+        sentiment, subjectivity = await function_app._read_aggregate(self.listed())
+        self.assertEqual(sentiment.tolist(), [0.1, 0.5, -1.0])
+        self.assertEqual(subjectivity.tolist(), [0.2, 0.25, 1.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
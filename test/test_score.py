@@ -0,0 +1,81 @@
+# Parity test between _score and the TextBlob pattern analyzer it is ported from
+# Run from the project root with: python -m unittest discover test
+import os
+import sys
+import unittest
+from textblob import TextBlob
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import function_app
+
+# Fixed corpus covering plain words, modifiers, negation, mixed-case contractions,
+# abbreviations, exclamation marks, emoticons, the sarcasm mark, quotes, line breaks
+# and empty or punctuation-only messages
+CORPUS = (
+    "",
+    "   ",
+    "...",
+    "!!!",
+    "??",
+    "ok",
+    "test",
+    "great",
+    "Terrible",
+    "This is a test message",
+    "I love this product, it is amazing.",
+    "The service was slow and the food was cold.",
+    "What a wonderful day!",
+    "What a wonderful day!!!",
+    "This is really good",
+    "This is very very bad",
+    "It is extremely terrible",
+    "The movie was terribly boring",
+    "It was not good",
+    "It was not a good idea",
+    "It is not really good",
+    "It is really not good",
+    "I don't like it",
+    "I DON'T like it",
+    "It ISN'T good!",
+    "Don't be sad :D",
+    "Ok.",
+    "OK. That is fine",
+    "Mr. Smith is great",
+    "Wow.... that was good\n\n:)",
+    "I never said it was bad",
+    "no problem at all",
+    "Oh great, another meeting (!)",
+    "Oh great, another meeting ( ! )",
+    ":)",
+    ":-(",
+    "I passed the exam :D",
+    "Missing you <3",
+    "That is so sad :'(",
+    "Hmm :/ not sure",
+    "Well ;) you know",
+    "♥ it",
+    "He said \"awful\" but meant 'awesome'",
+    "“Nice” work, ‘genius’",
+    "GOOD NEWS EVERYONE",
+    "The hotel was clean, friendly and cheap, but the location was awful.",
+    "I am happy... or am I?",
+)
+
+
+class TestScore(unittest.TestCase):
+
+    def test_matches_textblob(self):
+        for message in CORPUS:
+            with self.subTest(message=message):
+                expected = TextBlob(message).sentiment
+                polarity, subjectivity = function_app._score(message)
+                self.assertAlmostEqual(polarity, expected.polarity)
+                self.assertAlmostEqual(subjectivity, expected.subjectivity)
+
+    def test_lexicon_is_loaded(self):
+        # Without the lexicon _score silently falls back to TextBlob
+        self.assertIsNotNone(function_app._LEXICON)
+
+
+if __name__ == "__main__":
+    unittest.main()